@@ -1,9 +1,10 @@
 import argparse
 import asyncio
 import datetime as dt
-import random
+import secrets
 import sys
-from typing import List, Union
+from typing import Dict, List, Tuple, Union
+from zoneinfo import ZoneInfo
 
 import aiodebug.log_slow_callbacks
 import dateparser
@@ -13,25 +14,40 @@ import lightbulb as lb
 import regex as re
 import sqlalchemy as sql
 import uvloop
-from arrow import Arrow
+from sqlalchemy.dialects.mysql import insert as mysql_insert
 from sqlalchemy.ext.asyncio import create_async_engine
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.sql.expression import delete, select
 
 from . import cfg
 from .bot import SpecialFeaturesBot
-from .cfg import REGISTRATION_TIMEOUT
-from .schemas import Base, User
+from .cfg import (
+    REGISTRATION_TIMEOUT,
+    UNPARSEABLE_TOKEN_CACHE_SIZE,
+    USER_TZ_CACHE_SIZE,
+    USER_TZ_CACHE_TTL,
+)
+from .schemas import Base, User, migrate_update_id
 
 aiodebug.log_slow_callbacks.enable(0.05)
 
-db_engine = create_async_engine(cfg.db_url_async, connect_args=cfg.db_connect_args)
+db_engine = create_async_engine(
+    cfg.db_url_async, connect_args=cfg.db_connect_args, **cfg.db_engine_kwargs
+)
 db_session = sessionmaker(db_engine, **cfg.db_session_kwargs)
 
+# Registered user id -> (timezone, time cached at)
+# Saves a db round trip for every time message from a registered user
+user_tz_cache: Dict[int, Tuple[str, dt.datetime]] = {}
+# Time tokens that dateparser couldn't understand (used as an ordered set)
+# Successful parses can't be cached like this since tokens
+# like <5pm> or <in 2 hours> depend on when they're parsed
+unparseable_token_cache: Dict[str, None] = {}
+
 
 # Regex datetime markers excluding discord elements
 rgx_dt_markers = re.compile(
-    "(?!<(@|!|#|@!|@&)[0-9]+>|<a{0,1}:[a-zA-Z0-9_.]{2,32}:[0-9]+>|<t:[0-9]+:[a-zA-Z]{0,1}>)(<[^>]+>)"
+    "(?!<(@|!|#|@!|@&)[0-9]+>|<a{0,1}:[a-zA-Z0-9_.]{2,32}:[0-9]+>|<t:[0-9]+:[a-zA-Z]{0,1}>)(<[^<>]{1,64}>)"
 )
 # Regex get user from string with discord @user and nothing else
 rgx_d_user = re.compile("^<@(\d+)>$")
@@ -76,92 +92,158 @@ async def on_guild_rm(event: h.GuildLeaveEvent):
     await update_status(bot.d.guild_count)
 
 
-async def _time_list_from_string(text: str) -> List[dt.datetime]:
+def _parse_time_tokens(tokens: List[str]) -> List[Union[dt.datetime, None]]:
+    """Parses human readable time tokens into dt.datetimes
+
+    Returns a list in the same order as tokens, with None in place of
+    any token that can't be understood.
+    This is blocking and cpu heavy, so it is run in a worker thread"""
+    time_list = []
+    for token in tokens:
+        # Each token is parsed on its own so that one bad token
+        # doesn't stop the rest from being understood
+        try:
+            time = dateparser.parse(
+                token,
+                languages=["en"],
+                settings={"PREFER_DATES_FROM": "future"},
+                # Additionally try to recognize 24hr time
+                date_formats=["%H%M hrs", "%H%M"],
+            )
+        except Exception:
+            time = None
+        # Filter out items we don't understand or in an incorrect format
+        time_list.append(time if isinstance(time, dt.datetime) else None)
+    return time_list
+
+
+async def _time_list_from_string(text: str) -> List[Union[dt.datetime, None]]:
     """Converts a string to a parsed list of dt.datetimes
 
     - Takes the text,
     - pulls out everything surrounded by <> that isn't a discord element
     - puts each of these into a list (with the angle brackets themselves excluded)
-    - removes any links if they were picked up
-    - parse these into datetime objects
-    return the list of datetime objects
+    - skips any links if they were picked up
+    - skips anything we already know can't be parsed
+    - parse the rest into datetime objects (off the event loop)
+    return the list of datetime objects, one per time marker (rgx_dt_markers match)
+    in the text, with None for markers that weren't understood
     """
     # Find time tokens
-    time_list = rgx_dt_markers.findall(text)
+    token_list = rgx_dt_markers.findall(text)
     # Bring out the second capturing groups in the regex matches list
     # Note, the first is the negative lookahead for discord elements
-    time_list = [time[1] for time in time_list]
+    token_list = [token[1] for token in token_list]
     # Remove the angle brackets
-    time_list = [time[1:-1] for time in time_list]
-    # Ignore links
-    time_list = [time for time in time_list if not time.startswith("http")]
-    # Parse the human readable time to datetime format
-    time_list = [
-        dateparser.parse(
-            time,
-            languages=["en"],
-            settings={"PREFER_DATES_FROM": "future"},
-            # Additionally try to recognize 24hr time
-            date_formats=["%H%M hrs", "%H%M"],
+    token_list = [token[1:-1] for token in token_list]
+    # Ignore links and tokens that have failed to parse before
+    # Each distinct token only needs parsing once
+    parse_list = list(
+        dict.fromkeys(
+            token
+            for token in token_list
+            if not token.startswith("http") and token not in unparseable_token_cache
         )
-        for time in time_list
-    ]
-    # Filter out items we don't understand
-    time_list = [time for time in time_list if time is not None]
-    # Filter out items in an incorrect format
-    time_list = [time for time in time_list if isinstance(time, dt.datetime)]
-    return time_list
+    )
+    if not parse_list:
+        return []
+    # Parse the human readable time to datetime format in a worker thread
+    # so that the gateway heartbeat and other events aren't held up
+    parsed_list = await asyncio.to_thread(_parse_time_tokens, parse_list)
+
+    for token, time in zip(parse_list, parsed_list):
+        if time is None:
+            if len(unparseable_token_cache) >= UNPARSEABLE_TOKEN_CACHE_SIZE:
+                # Dicts keep insertion order so the first key is the oldest
+                del unparseable_token_cache[next(iter(unparseable_token_cache))]
+            unparseable_token_cache[token] = None
+
+    parsed_tokens = dict(zip(parse_list, parsed_list))
+    return [parsed_tokens.get(token) for token in token_list]
 
 
 async def _get_user_by_id(id: int) -> Union[User, None]:
     """Returns the user or None if they aren't found in the timezone db"""
+    # Read only, so no explicit transaction is needed
     async with db_session() as session:
-        async with session.begin():
-            user = (
-                await session.execute(select(User).where(User.id == int(id)))
-            ).fetchone()
+        user = (
+            await session.execute(select(User).where(User.id == int(id)))
+        ).fetchone()
     return user if user is None else user[0]
 
 
-async def _convert_time_list_fm_user(user: User, time_list: List) -> List[str]:
-    """Takes a user and times in their zone and converts it to utc unix time
+async def _get_user_tz(id: int) -> Union[str, None]:
+    """Returns the user's timezone or None if they haven't registered one
+
+    Registered timezones are served from user_tz_cache for up to
+    USER_TZ_CACHE_TTL before being looked up in the db again"""
+    id = int(id)
+    now = dt.datetime.now()
 
-    When given a user (from the timezone db) and a time list (of dt.datetime objs)
-    this function will convert the time list into utc time,
-    then convert these into unix time (seconds since epoch start)
+    cached = user_tz_cache.pop(id, None)
+    if cached is not None and now - cached[1] < USER_TZ_CACHE_TTL:
+        # Reinsert so that the most recently used entries are evicted last
+        user_tz_cache[id] = cached
+        return cached[0]
+
+    # Only the tz column is selected, no User object is built for this
+    async with db_session() as session:
+        tz = (
+            await session.execute(select(User.tz).where(User.id == id))
+        ).scalar_one_or_none()
+    if not tz:
+        # Don't cache unregistered users so that a registration
+        # completed on the web server is picked up straight away
+        return None
+
+    if len(user_tz_cache) >= USER_TZ_CACHE_SIZE:
+        # Dicts keep insertion order so the first key is the least recently used
+        del user_tz_cache[next(iter(user_tz_cache))]
+    user_tz_cache[id] = (tz, now)
+    return tz
+
+
+async def _convert_time_list_fm_tz(
+    tz: str, time_list: List[Union[dt.datetime, None]]
+) -> List[Union[str, None]]:
+    """Takes a timezone and times in that zone and converts it to utc unix time
+
+    When given a timezone (from the timezone db) and a time list (of dt.datetime objs)
+    this function will convert the time list into unix time (seconds since epoch start)
     then convert these into a list of discord times that auto convert for everyone
-    assuming the user is speaking in their own time zone"""
-    # Get the user's TimeZone
-    tz = str(user.tz)
-
-    # Account for time zones
-    time_list = [Arrow.fromdatetime(time, tz) for time in time_list]
-    # Convert to UTC
-    utc_time_list = [time.to("UTC") for time in time_list]
-    # Convert to unix time
+    assuming the user is speaking in their own time zone
+    None entries in the time list are kept as None"""
+    zone = ZoneInfo(str(tz))
+
+    # Account for time zones and convert to unix time in one pass
+    # Note, a unix timestamp is the same in every zone so there is
+    # no need to convert to UTC first
     unix_time_list = [
-        int((time - Arrow(1970, 1, 1)).total_seconds()) for time in utc_time_list
+        None if time is None else int(time.replace(tzinfo=zone).timestamp())
+        for time in time_list
+    ]
+    discord_time_list = [
+        None if time is None else "<t:" + str(time) + ":t>" for time in unix_time_list
     ]
-    discord_time_list = ["<t:" + str(time) + ":t>" for time in unix_time_list]
     return discord_time_list
 
 
-async def _reply_from_user_and_times(user: User, time_list: List) -> str:
-    time_list = await _convert_time_list_fm_user(user, time_list)
+async def _reply_from_tz_and_times(tz: str, time_list: List) -> str:
+    time_list = await _convert_time_list_fm_tz(tz, time_list)
     # Create reply text
-    reply = ", ".join(time_list)
+    reply = ", ".join(time for time in time_list if time is not None)
     reply = "That's " + reply + " auto-converted to local time."
     return reply
 
 
-async def _embed_from_user_times_and_text(
-    user: User, time_list: List, text: str
-) -> h.Embed:
-    """Substitue times into <text> after converting them for <user>"""
-    time_list = await _convert_time_list_fm_user(user, time_list)
-    reply = text
-    for time in time_list:
-        reply = rgx_dt_markers.sub(time, reply, count=1)
+async def _embed_from_tz_times_and_text(tz: str, time_list: List, text: str) -> h.Embed:
+    """Substitue times into <text> after converting them from <tz>
+
+    <time_list> must be as returned by _time_list_from_string(<text>)"""
+    time_iter = iter(await _convert_time_list_fm_tz(tz, time_list))
+    # Each time marker in the text has its own entry in the time list,
+    # markers that weren't understood are left as they are
+    reply = rgx_dt_markers.sub(lambda match: next(time_iter) or match.group(0), text)
 
     return h.Embed(description=reply, colour=cfg.EXOTIC_YELLOW)
 
@@ -187,39 +269,31 @@ async def _add_user_persona_to_embed(event: h.MessageCreateEvent, embed: h.Embed
 async def register_user(message: h.Message):
     """Adds a user to the db and sends them a link to add their time zone there"""
     user_id = message.author.id
+    user_tz_cache.pop(int(user_id), None)
+
+    # Generate a new link_id / update_id
+    # 64 random bits, so this won't realistically clash with any other link_id
+    # Note, the upsert below doesn't guard against a clash: one on update_id
+    # would update the other user's row instead of failing
+    link_id = secrets.token_urlsafe(8)
 
     # Add the link_id to the db
     async with db_session() as session:
-        # Generate a new link_id / update_id
-        # Ensure that this does not clash with any currently
-        # valid link_id
+        # Add or update the user's records in a single statement
         async with session.begin():
-            users = (
-                await session.execute(
-                    select(User.update_dt, User.update_id).where(
-                        dt.datetime.now() - User.update_dt <= REGISTRATION_TIMEOUT
-                    )
-                )
-            ).fetchall()
-            users = [] if users is None else users
-            used_link_ids = set([user.update_id for user in users])
-        while True:
-            link_id = random.randrange(1000000, 9999999, 1)
-            if link_id not in used_link_ids:
-                break
-
-        # Add or prepare to update the user's records
-        async with session.begin():
-            instance = await session.get(User, int(user_id))
-            if instance is None:
-                # If the user hasn't registered yet, create a row for them
-                instance = User(int(user_id), "")
-            else:
-                # If they have, make sure to update their datetime to allow
-                # them to register
-                instance.update_dt = dt.datetime.now()
-            instance.update_id = link_id
-            session.add(instance)
+            stmt = mysql_insert(User).values(
+                id=int(user_id),
+                tz="",
+                update_id=link_id,
+                update_dt=dt.datetime.now(),
+            )
+            # If the user already has a row, keep their tz but update their
+            # link_id and datetime to allow them to register
+            stmt = stmt.on_duplicate_key_update(
+                update_id=stmt.inserted.update_id,
+                update_dt=stmt.inserted.update_dt,
+            )
+            await session.execute(stmt)
 
     await message.author.send(
         "Visit this link to register your timezone: \n\n<{}/register/{}>\n\n".format(
@@ -247,6 +321,7 @@ async def deregister_handler(ctx: lb.Context):
         async with session.begin():
             # Delete the user's row
             await session.execute(delete(User).where(User.id == int(ctx.author.id)))
+    user_tz_cache.pop(int(ctx.author.id), None)
 
     await ctx.respond("You have successfully deregistered")
 
@@ -267,22 +342,23 @@ async def time_message_handler(event: h.MessageCreateEvent):
     message = event.message
     content = message.content
 
-    # Return if we receive an empty message
-    if not content:
+    # Return if we receive an empty message or one that can't contain
+    # a time marker, this is most messages so skip the regex for them
+    if not content or "<" not in content:
         return
 
     time_list = await _time_list_from_string(content)
 
     # If no times are specified/understood, skip the message
-    if len(time_list) == 0:
+    if not any(time_list):
         return
 
-    # Find the user in the db
-    user = await _get_user_by_id(user_id)
+    # Find the user's timezone
+    tz = await _get_user_tz(user_id)
 
     # If we can't find the user in the db, mention that they can register
     # or if their timezone record is empty
-    is_user_not_registered: bool = user is None or user.tz == ""
+    is_user_not_registered: bool = tz is None
     if is_user_not_registered:
         response_msg: h.Message = await message.respond(
             "You haven't registered with me yet\n"
@@ -301,7 +377,7 @@ async def time_message_handler(event: h.MessageCreateEvent):
                 break
             elif user is None or user.tz == "":
                 continue
-            embed = await _embed_from_user_times_and_text(user, time_list, content)
+            embed = await _embed_from_tz_times_and_text(user.tz, time_list, content)
             embed = await _add_user_persona_to_embed(event=event, embed=embed)
             try:
                 await response_msg.edit(content="", embed=embed)
@@ -310,8 +386,8 @@ async def time_message_handler(event: h.MessageCreateEvent):
                 pass
             break
     else:
-        # Use the time list and the user object to create a reply
-        embed = await _embed_from_user_times_and_text(user, time_list, content)
+        # Use the time list and the user's timezone to create a reply
+        embed = await _embed_from_tz_times_and_text(tz, time_list, content)
         embed = await _add_user_persona_to_embed(event=event, embed=embed)
         response_msg = await message.respond(content="", embed=embed, reply=True)
         # Replace the below with buttons
@@ -322,9 +398,16 @@ async def time_message_handler(event: h.MessageCreateEvent):
 @bot.listen()
 async def pre_start(event: h.StartingEvent):
     async with db_engine.begin() as conn:
+        await conn.run_sync(migrate_update_id)
         await conn.run_sync(Base.metadata.create_all)
 
 
+@bot.listen()
+async def post_stop(event: h.StoppedEvent):
+    # Close pooled db connections instead of leaving them open till exit
+    await db_engine.dispose()
+
+
 @bot.command
 @lb.option(name="iii", description="All nothings begin therewhen", default="iii")
 @lb.option(name="ii", description="Dying into infinite composite", default="ii")
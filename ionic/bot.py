@@ -2,7 +2,8 @@
 # This is the base lightbulb.BotApp but with added utility functions
 
 import datetime as dt
-from typing import Dict, List, Union
+import logging
+from typing import Awaitable, Callable, Dict, List, Union
 
 import hikari as h
 import lightbulb as lb
@@ -10,6 +11,8 @@ import regex as re
 
 from . import cfg
 
+_LOG = logging.getLogger(__name__)
+
 
 class CachedFetchBot(lb.BotApp):
     """lb.BotApp subclass with async methods that fetch objects from cache if possible"""
@@ -72,8 +75,16 @@ class SpecialFeaturesBot(CachedFetchBot):
         # and removed by cls.undo_react_storm_user(...)
         self.reactors_register: Dict[Union[str, h.Emoji], Dict[int, dt.datetime]] = {}
         # The above dict is used by the below method which is a staticmethod
-        # that listens to the GuildMessageCreate event
-        self.listen()(self._user_reactor)
+        # that handles the GuildMessageCreate event
+        #
+        # Handlers for the GuildMessageCreate event
+        # These are all run by a single listener (cls._guild_message_dispatcher)
+        # instead of each being a listener of its own, which would have every
+        # message spawn a task per handler even though most return straight away
+        self.guild_message_handlers: List[
+            Callable[[h.GuildMessageCreateEvent], Awaitable[None]]
+        ] = [self._user_reactor]
+        self.listen()(self._guild_message_dispatcher)
 
     def react_to_guild_messages(
         self,
@@ -116,7 +127,8 @@ class SpecialFeaturesBot(CachedFetchBot):
                 # if there is a match, react with the specified emoji
                 await msg.add_reaction(reaction)
 
-        return self.listen()(reaction_handler)
+        self.guild_message_handlers.append(reaction_handler)
+        return reaction_handler
 
     def react_to_guild_reactions(
         self,
@@ -139,18 +151,25 @@ class SpecialFeaturesBot(CachedFetchBot):
             emoji_name: str = event.emoji_name
             emoji_id: str = event.emoji_id
 
-            if allowed_uids and user_id not in allowed_uids:
-                # Ignore the event if the user's id is not in allowed_users
-                # Do not ignore if allowed_users is None since that indicates
-                # this is enabled for all users
+            # Ignore the bot's own reactions, these are the ones
+            # added below and would only be added again
+            me = bot.get_me()
+            if me is not None and user_id == me.id:
                 return
 
+            # Server check before user check since it rules out the most events
             if allowed_servers and guild_id not in allowed_servers:
                 # Ignore the event if the guild id is not in allowed_servers
                 # Do not ignore if allowed_servers is None since that indicates
                 # this is enabled for all guilds
                 return
 
+            if allowed_uids and user_id not in allowed_uids:
+                # Ignore the event if the user's id is not in allowed_users
+                # Do not ignore if allowed_users is None since that indicates
+                # this is enabled for all users
+                return
+
             if trigger_regex.search(emoji_name):
                 # Search emoji's name with regex,
                 # if there is a match, react with the same emoji
@@ -180,11 +199,18 @@ class SpecialFeaturesBot(CachedFetchBot):
         else:
             user_id = user.id
 
-        react_till = dt.datetime.now() + time
+        now = dt.datetime.now()
+        react_till = now + time
 
         if reaction not in self.reactors_register:
             self.reactors_register[reaction] = {}
 
+        # Drop users whose react till time has passed so that the register
+        # doesn't keep an entry for every user ever react stormed
+        user_dict = self.reactors_register[reaction]
+        for expired_user_id in [uid for uid, till in user_dict.items() if till < now]:
+            del user_dict[expired_user_id]
+
         try:
             # Update the reactors_register with the user id and/or react till time
             self.reactors_register[reaction][user_id] = max(
@@ -270,7 +296,16 @@ class SpecialFeaturesBot(CachedFetchBot):
                         dt.timedelta(minutes=2), user_id, reaction
                     )
 
-        self.listen()(reaction_handler)
+        self.guild_message_handlers.append(reaction_handler)
+
+    @staticmethod
+    async def _guild_message_dispatcher(event: h.GuildMessageCreateEvent):
+        for handler in event.app.guild_message_handlers:
+            try:
+                await handler(event)
+            except Exception:
+                # Log and carry on so one failing handler doesn't stop the rest
+                _LOG.exception("Error in guild message handler %s", handler)
 
     @staticmethod
     async def _user_reactor(event: h.GuildMessageCreateEvent):
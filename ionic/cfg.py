@@ -33,6 +33,17 @@ db_url = db_url[repl_till:]
 db_url_async = "mysql+asyncmy" + db_url
 db_url = "mysql" + db_url
 
+# Async SQLAlchemy DB Engine KWArg Parameters
+# Connections are pooled and reused across messages / requests,
+# pre pinged since idle ones may have been dropped by the server
+# and recycled before they hit MySQL's wait_timeout
+db_engine_kwargs = {
+    "pool_size": 20,
+    "max_overflow": 10,
+    "pool_pre_ping": True,
+    "pool_recycle": 1800,
+}
+
 db_session_kwargs_sync = {
     "expire_on_commit": False,
 }
@@ -51,6 +62,9 @@ if _getenv("MYSQL_SSL", "true") == "true":
 
 # Constants
 REGISTRATION_TIMEOUT = dt.timedelta(minutes=10)
+USER_TZ_CACHE_TTL = dt.timedelta(minutes=5)
+USER_TZ_CACHE_SIZE = 10_000
+UNPARSEABLE_TOKEN_CACHE_SIZE = 4096
 MESSAGE_DELETE_REACTION = "❌"
 MESSAGE_REFRESH_REACTION = "🔄"
 EMOJI_GUILD = 920027638179966996
@@ -1,15 +1,20 @@
 import asyncio
 import datetime as dt
 
+from sqlalchemy import inspect
+from sqlalchemy.engine import Connection
 from sqlalchemy.ext.asyncio import create_async_engine
 from sqlalchemy.orm import declarative_base
+from sqlalchemy.sql.expression import text, update
 from sqlalchemy.sql.schema import Column
-from sqlalchemy.sql.sqltypes import TIMESTAMP, VARCHAR, BigInteger
+from sqlalchemy.sql.sqltypes import TIMESTAMP, VARCHAR, BigInteger, Integer
 
 from . import cfg
 
 Base = declarative_base()
 
+UPDATE_ID_COLLATION = "ascii_bin"
+
 
 class User(Base):
     __tablename__ = "user"
@@ -17,7 +22,13 @@ class User(Base):
     id = Column("id", BigInteger, primary_key=True)
     tz = Column("tz", VARCHAR(64))
     # Column used to mark a user for an update
-    update_id = Column("update_id", BigInteger)
+    # Binary collation since link ids are case sensitive
+    update_id = Column(
+        "update_id",
+        VARCHAR(16, collation=UPDATE_ID_COLLATION),
+        unique=True,
+        index=True,
+    )
     update_dt = Column("update_dt", TIMESTAMP)
 
     def __init__(self, id, tz):
@@ -37,5 +48,37 @@ async def recreate_all():
         await conn.run_sync(Base.metadata.create_all)
 
 
+def migrate_update_id(conn: Connection):
+    """Moves update_id from numeric link ids to unique, case sensitive url safe tokens
+
+    Run with conn.run_sync(...) before Base.metadata.create_all,
+    does nothing if the column is already up to date"""
+    inspector = inspect(conn)
+    if not inspector.has_table(User.__tablename__):
+        # The table will be created with the new schema
+        return
+    columns = {
+        column["name"]: column for column in inspector.get_columns(User.__tablename__)
+    }
+    column_type = columns["update_id"]["type"]
+    if getattr(column_type, "collation", None) == UPDATE_ID_COLLATION:
+        # Already migrated
+        return
+
+    if isinstance(column_type, Integer):
+        # Numeric link ids can't be reused once update_id is a string token, and
+        # expired ones may repeat, which would break the new unique index
+        conn.execute(update(User).values(update_id=None))
+    conn.execute(
+        text(
+            "ALTER TABLE `user` MODIFY `update_id` VARCHAR(16) COLLATE {}".format(
+                UPDATE_ID_COLLATION
+            )
+        )
+    )
+    for index in User.__table__.indexes:
+        index.create(conn, checkfirst=True)
+
+
 if __name__ == "__main__":
     asyncio.run(recreate_all())
@@ -1,8 +1,12 @@
-import asyncio
 import datetime as dt
+import html
+from typing import Union
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 
 import jinja2
 import quart
+import regex as re
+import uvloop
 from hypercorn.asyncio import serve
 from hypercorn.config import Config
 from jinja2.loaders import PackageLoader
@@ -10,12 +14,15 @@ from jinja2.utils import select_autoescape
 from quart import jsonify
 from sqlalchemy.ext.asyncio import create_async_engine
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy.sql.expression import select
+from sqlalchemy.sql.expression import update
 
 from . import cfg
 from .cfg import REGISTRATION_TIMEOUT
 from .schemas import User
 
+# Regex matching a link id generated by secrets.token_urlsafe
+rgx_link_id = re.compile("[A-Za-z0-9_-]{1,16}")
+
 config = Config()
 config.bind = ["0.0.0.0:{}".format(cfg.port)]
 j_env = jinja2.Environment(
@@ -24,20 +31,36 @@ j_env = jinja2.Environment(
 register_template = j_env.get_template("register.jinja")
 success_page = j_env.get_template("success.jinja")
 failure_page = j_env.get_template("failure.jinja")
+# Register page rendered with LINK_ID_PLACEHOLDER in place of the link id
+LINK_ID_PLACEHOLDER = "__LINK_ID__"
+register_page: Union[str, None] = None
 app = quart.Quart("ionic")
 
-db_engine = create_async_engine(cfg.db_url_async, connect_args=cfg.db_connect_args)
+db_engine = create_async_engine(
+    cfg.db_url_async, connect_args=cfg.db_connect_args, **cfg.db_engine_kwargs
+)
 db_session = sessionmaker(db_engine, **cfg.db_session_kwargs)
 
 
+@app.after_serving
+async def dispose_db_engine():
+    # Close pooled db connections once hypercorn has drained its requests
+    await db_engine.dispose()
+
+
 @app.route("/register/<link_id>")
-async def send_payload(link_id: int):
-    payload = await register_template.render_async(
-        base_url=cfg.app_url,
-        link_id=link_id,
-        stylesheet=quart.url_for("static", filename="styles.css"),
-    )
-    return payload
+async def send_payload(link_id: str):
+    global register_page
+    if register_page is None:
+        # Only the link id changes between requests, so the page is rendered once
+        # This happens on the first request since url_for needs a request context
+        register_page = await register_template.render_async(
+            base_url=cfg.app_url,
+            link_id=LINK_ID_PLACEHOLDER,
+            stylesheet=quart.url_for("static", filename="styles.css"),
+        )
+    payload = register_page.replace(LINK_ID_PLACEHOLDER, html.escape(link_id))
+    return quart.Response(payload, mimetype="text/html")
 
 
 @app.route("/static/<path:path>")
@@ -67,26 +90,40 @@ async def receive_timezone():
     link_id = timezone["link_id"]
     timezone = timezone["tz"]
 
+    if not isinstance(link_id, str) or not rgx_link_id.fullmatch(link_id):
+        # Only url safe tokens can be link ids, anything else (eg: numbers or
+        # null) would be compared loosely by MySQL and could match other rows
+        quart.abort(401)
+
+    try:
+        # Only store timezones we can convert times with
+        ZoneInfo(timezone)
+    except (TypeError, ValueError, ZoneInfoNotFoundError):
+        quart.abort(400)
+
     async with db_session() as session:
         async with session.begin():
-            user = (
-                await session.execute(
-                    select(User).where(User.update_id == int(link_id))
+            # Set the timezone only if this link was issued and hasn't expired
+            result = await session.execute(
+                update(User)
+                .where(
+                    User.update_id == link_id,
+                    User.update_dt >= dt.datetime.now() - REGISTRATION_TIMEOUT,
                 )
-            ).fetchone()
-            if user is None:
-                # If there is no such user, then no such user
-                # has requested registration
-                quart.abort(401)
-            user = user[0]
-            if dt.datetime.now() - user.update_dt > REGISTRATION_TIMEOUT:
-                quart.abort(401)
-            user.tz = timezone
+                .values(tz=timezone)
+                # A link belongs to a single user, never update more than that
+                .with_dialect_options(mysql_limit=1)
+            )
+    if result.rowcount != 1:
+        # Either no such user has requested registration
+        # or their registration link has expired
+        quart.abort(401)
     return jsonify(success=True)
 
 
 if __name__ == "__main__":
-    asyncio.run(
+    # Serve on a uvloop event loop
+    uvloop.run(
         serve(
             app,
             config,